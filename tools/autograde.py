@@ -1,43 +1,46 @@
 #!/usr/bin/env python3
-import asyncio, os, pathlib, difflib, sys
+import asyncio, os, pathlib, sys
 from wokwi_client import WokwiClient, GET_TOKEN_URL
 from wokwi_client.serial import monitor_lines
 
+try:
+    import uvloop  # optional: libuv-backed event loop; pre-0.18 (no uvloop.run) falls back to asyncio
+except ImportError:
+    uvloop = None
+
 # Remove main.c from student view, figure out a way to import student code into autograder and then Get VCD output from logic analyzer
 
 EXPECTED = pathlib.Path("tests/expected_serial.txt").read_text().splitlines()
+ARTIFACT_DIR = pathlib.Path("artifacts")  # run outputs; keeps tests/ fixtures untouched
+SERIAL_LOG = ARTIFACT_DIR / "serial.txt"
 TIMEOUT_S = 6.0
+ECHO_FLUSH_BYTES = 1 << 16  # serial echo is batched: flush at this size...
+ECHO_FLUSH_S = 0.05         # ...or after this long, whichever comes first
 
 # Drive the pushbutton: pressed -> released
 async def drive_button(client):
-
-    async def press_at(t_press: float, t_release: float):
-        await client.wait_until_simulation_time(t_press - 0.002)  # small pre-roll
+    presses = [(.5, .7), (.9, 1.1)]  # (press, release) pairs
+
+    # Flatten into (sim time, pressed value, requested time) edges with small guard bands
+    edges = sorted(
+        [(t_press - 0.002, 1, t_press) for t_press, _t_release in presses]
+        + [(t_release + 0.002, 0, t_release) for _t_press, t_release in presses]
+    )
+    for t_edge, value, t_requested in edges:
+        await client.wait_until_simulation_time(t_edge)
         try:
-            await client.set_control(part="btn1", control="pressed", value=1)
-            await client.wait_until_simulation_time(t_press + 0.002)  # small post-roll
-            # p = await client.read_pin(part="esp", pin="D4")
-            # print(f"[debug] after press@{t_press:.3f}s D4={p}")
+            await client.set_control(part="btn1", control="pressed", value=value)
         except Exception as e:
-            print(f"[autograde] set_control press failed: {e!r}", file=sys.stderr)
+            action = "press" if value else "release"
+            print(f"[autograde] set_control {action} failed: {e!r}", file=sys.stderr)
 
-        led = await client.read_pin(part="esp", pin="D26")  # MCU LED pin, just to see if it works
-        button = await client.read_pin(part="esp", pin="D4")
-        p = await client.read_pin(part="esp", pin="D5")
+        if value:
+            await client.wait_until_simulation_time(t_requested + 0.002)  # small post-roll before the debug reads
+            led = await client.read_pin(part="esp", pin="D26")  # MCU LED pin, just to see if it works
+            button = await client.read_pin(part="esp", pin="D4")
+            p = await client.read_pin(part="esp", pin="D5")
 
-        print(f"[debug] at press@{t_press:.3f}s LED={led}, BTN={button}, D5={p}")
-
-        await client.wait_until_simulation_time(t_release + 0.002)
-        try:
-            await client.set_control(part="btn1", control="pressed", value=0)
-            await client.wait_until_simulation_time(t_release + 0.002)
-            # p = await client.read_pin(part="esp", pin="D4")
-            # print(f"[debug] after release@{t_release:.3f}s D4={p}")
-        except Exception as e:
-            print(f"[autograde] set_control release failed: {e!r}", file=sys.stderr)
-    
-    await press_at(.5, .7)  # initial press
-    await press_at(.9, 1.1)  # second press
+            print(f"[debug] at press@{t_requested:.3f}s LED={led}, BTN={button}, D5={p}")
 
 async def main():
     token = os.getenv("WOKWI_CLI_TOKEN")
@@ -53,38 +56,65 @@ async def main():
 
     client = WokwiClient(token)
     await client.connect()  # connect to Wokwi simulator server
-    # Upload required files
-    await client.upload_file("diagram.json")
-    await client.upload_file("wokwi_button_led.elf", local_path=firmware)
-    await client.upload_file("wokwi_button_led.bin", local_path=firmware)
+    # Upload required files (the .elf only if the build produced a separate one)
+    elf_path = firmware.with_suffix(".elf")
+    has_elf = elf_path.exists() and elf_path != firmware
+    uploads = [
+        client.upload_file("diagram.json"),
+        client.upload_file("wokwi_button_led.bin", local_path=firmware),
+    ]
+    if has_elf:
+        uploads.append(client.upload_file("wokwi_button_led.elf", local_path=elf_path))
+    await asyncio.gather(*uploads)  # independent uploads, overlap their round-trips
 
 
     # Start the simulation and stream serial output
-    captured = []
     done_event = asyncio.Event()
-    release_count = 0  # for debugging, not used in the final version
 
     
 
     async def capture_serial():
-        nonlocal release_count
-        async for raw in monitor_lines(client._transport):  # internal helper used by serial_monitor_cat
-            line = raw.decode(errors="replace").rstrip("\r\n")
-            print(line)  # echo to CI logs
-            captured.append(line)
-            if line.strip().upper() == "DONE":
-                done_event.set()
-                break
-            # if line.strip() == "EVENT: Button Release":
-            #     release_count += 1
-            #     if release_count >= 2:
-            #         done_event.set()
-            #         break
+        loop = asyncio.get_running_loop()
+        echo = bytearray()
+        flush_handle = None
+
+        def flush_echo():
+            nonlocal flush_handle
+            if flush_handle is not None:
+                flush_handle.cancel()
+                flush_handle = None
+            if echo:
+                sys.stdout.flush()  # keep ordering with anything print()ed meanwhile
+                sys.stdout.buffer.write(echo)
+                sys.stdout.buffer.flush()
+                echo.clear()
+
+        # Stream each line to disk as it arrives (large buffer) instead of joining at the end
+        ARTIFACT_DIR.mkdir(parents=True, exist_ok=True)
+        try:
+            with SERIAL_LOG.open("w", encoding="utf-8", newline="", buffering=1 << 16) as f:
+                async for raw in monitor_lines(client._transport):  # internal helper used by serial_monitor_cat
+                    done = raw.strip().upper() == b"DONE"  # bytes compare, no extra str copies
+                    line = raw.decode(errors="replace").rstrip("\r\n")
+                    # echo to CI logs
+                    echo += raw.rstrip(b"\r\n")
+                    echo += b"\n"
+                    if len(echo) >= ECHO_FLUSH_BYTES:
+                        flush_echo()
+                    elif flush_handle is None:
+                        flush_handle = loop.call_later(ECHO_FLUSH_S, flush_echo)
+                    f.write(line)
+                    f.write("\n")
+                    if done:
+                        done_event.set()
+                        break
+        finally:
+            flush_echo()  # never leave echoed lines behind on DONE, timeout or cancel
 
 
     cap_task = asyncio.create_task(capture_serial())
 
-    await client.start_simulation(firmware="wokwi_button_led.bin", elf="wokwi_button_led.elf")
+    await client.start_simulation(firmware="wokwi_button_led.bin", elf="wokwi_button_led.elf" if has_elf else None)
 
     sim_task = asyncio.create_task(drive_button(client))
 
@@ -112,6 +142,5 @@ async def main():
 
 
 
-
 if __name__ == "__main__":
-    asyncio.run(main())
+    (getattr(uvloop, "run", None) or asyncio.run)(main())
@@ -11,7 +11,8 @@ What it does:
   6) Compares logs to golden copies and prints a concise verdict + unified diff
 
 Requires:
-  - pip install wokwi-client
+  - Python 3.11+ (asyncio.TaskGroup)
+  - pip install wokwi-client (optionally uvloop for a faster event loop)
   - WOKWI_CLI_TOKEN environment variable (https://wokwi.com/dashboard/ci)
 """
 import asyncio
@@ -21,11 +22,16 @@ import os
 import pathlib
 import random
 import sys
-from typing import Iterable, List, Tuple, Optional
+from typing import List, Optional, Sequence, TextIO, Tuple
 
 from wokwi_client import WokwiClient, GET_TOKEN_URL  # API docs: https://wokwi.github.io/wokwi-python-client/
 from wokwi_client.serial import monitor_lines
 
+try:
+    import uvloop  # optional: libuv-backed event loop; pre-0.18 (no uvloop.run) falls back to asyncio
+except ImportError:
+    uvloop = None
+
 # -----------------------
 # Config (adjust as needed)
 # -----------------------
@@ -37,7 +43,11 @@ EXPECTED_PROBES_CSV  = pathlib.Path("tests/expected_probes.csv")  # optional; co
 # Autograder knobs
 TIMEOUT_S = 6.0
 SERIAL_DONE_TOKEN = "DONE"     # when seen on serial, we consider the test complete
+SERIAL_DONE_BYTES = SERIAL_DONE_TOKEN.encode()  # matched against raw serial bytes
 RANDOM_SEED = 1337             # set to None for non-deterministic randomization
+ECHO_FLUSH_BYTES = 1 << 16     # serial echo to stdout is batched: flush at this size...
+ECHO_FLUSH_S = 0.05            # ...or after this many seconds, whichever comes first
+PROBE_FLUSH_ROWS = 64          # probe CSV rows are written (and flushed to disk) in batches of this size
 
 # Probes to sample (part, pin, label). Label appears as CSV column header.
 # For ESP32 common pins, see your firmware & diagram.json.
@@ -46,11 +56,13 @@ PROBES: List[Tuple[str, str, str]] = [
     ("esp", "D4",  "BTN"),     # example: button input (GPIO)
     ("esp", "D5",  "D5"),      # example: extra pin to watch
 ]
+PROBE_HEADER = ["time_s"] + [label for *_ignore, label in PROBES]
 
 # Times (in seconds) to sample probes. You can mix fixed “important” stamps + randomized stamps.
 IMPORTANT_TIMES = [0.48, 0.70, 0.90, 1.10]  # small pre/post around button actions
 NUM_RANDOM_TIMES = 6                         # additional random samples in [t_min, t_max]
 RAND_WINDOW = (0.2, 1.6)
+MIN_PROBE_GAP_S = 0.0005                     # random samples closer than this to the previous one are dropped
 
 # Input drive plan for a pushbutton named "btn1" in diagram.json
 BUTTON_PRESSES = [
@@ -73,8 +85,27 @@ def read_expected_lines(path: pathlib.Path) -> List[str]:
         return []
     return path.read_text().splitlines()
 
-def unified_diff_str(expected: Iterable[str], actual: Iterable[str], *, fromfile="expected", tofile="actual") -> str:
-    return "".join(difflib.unified_diff(list(expected), list(actual), fromfile=fromfile, tofile=tofile, lineterm=""))
+def read_changed_logs(expected: pathlib.Path, actual: pathlib.Path) -> Optional[Tuple[List[str], List[str]]]:
+    """
+    Return (expected_lines, actual_lines) for two logs (a missing file reads as empty),
+    or None if they are byte-identical, in which case nothing is decoded or split.
+    Callers compare the lists (so line-ending-only differences still match) and
+    reuse them for the diff.
+    """
+    expected_data = expected.read_bytes() if expected.exists() else b""
+    actual_data = actual.read_bytes() if actual.exists() else b""
+    if expected.exists() and actual.exists() and expected_data == actual_data:
+        return None
+    # Decode the bytes already in hand (no second read); splitlines() still tolerates CRLF/LF
+    return expected_data.decode().splitlines(), actual_data.decode().splitlines()
+
+def stream_unified_diff(expected: Sequence[str], actual: Sequence[str], *, fromfile="expected", tofile="actual",
+                        out: Optional[TextIO] = None) -> None:
+    """Write a unified diff line by line as difflib produces it (stdout by default)."""
+    out = out or sys.stdout
+    for line in difflib.unified_diff(expected, actual, fromfile=fromfile, tofile=tofile, lineterm=""):
+        out.write(line)
+        out.write("\n")
 
 def find_firmware(build_dir: pathlib.Path = pathlib.Path("build")) -> pathlib.Path:
     """
@@ -93,13 +124,21 @@ def ensure_artifacts_dir():
 def make_probe_schedule() -> List[float]:
     """
     Merge important timestamps with randomized samples, sort & unique.
+    Times are quantized to 1 us (the CSV resolution) before de-duplication, and a
+    random sample within MIN_PROBE_GAP_S of the previous one is skipped, since each
+    timestamp costs a server round-trip. Important timestamps are always kept.
     Random samples are deterministic if RANDOM_SEED is set.
     """
-    if RANDOM_SEED is not None:
-        random.seed(RANDOM_SEED)
+    rng = random.Random(RANDOM_SEED)  # private generator; None seeds from the OS
     t_min, t_max = RAND_WINDOW
-    rand_times = [random.uniform(t_min, t_max) for _ in range(NUM_RANDOM_TIMES)]
-    times = sorted(set(IMPORTANT_TIMES + rand_times))
+    span = t_max - t_min
+    rand_times = [rng.random() * span + t_min for _ in range(NUM_RANDOM_TIMES)]
+    important = {round(t, 6) for t in IMPORTANT_TIMES}
+    times: List[float] = []
+    for t in sorted(important | {round(t, 6) for t in rand_times}):
+        if times and t - times[-1] < MIN_PROBE_GAP_S and t not in important:
+            continue
+        times.append(t)
     return times
 
 
@@ -114,63 +153,98 @@ async def capture_serial(transport, done_event: asyncio.Event):
     monitor serial and control simulations programmatically. :contentReference[oaicite:2]{index=2}
     """
     ensure_artifacts_dir()
-    with SERIAL_LOG.open("w", encoding="utf-8", newline="") as f:
-        async for raw in monitor_lines(transport):
-            line = raw.decode(errors="replace").rstrip("\r\n")
-            print(line)     # echo to CI logs
-            f.write(line + "\n")
-            if line.strip().upper() == SERIAL_DONE_TOKEN:
-                done_event.set()
-                break
+    loop = asyncio.get_running_loop()
+    echo = bytearray()
+    flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def flush_echo():
+        nonlocal flush_handle
+        if flush_handle is not None:
+            flush_handle.cancel()
+            flush_handle = None
+        if echo:
+            sys.stdout.flush()  # keep ordering with anything print()ed meanwhile
+            sys.stdout.buffer.write(echo)
+            sys.stdout.buffer.flush()
+            echo.clear()
+
+    try:
+        with SERIAL_LOG.open("w", encoding="utf-8", newline="") as f:
+            async for raw in monitor_lines(transport):
+                done = raw.strip().upper() == SERIAL_DONE_BYTES
+                line = raw.decode(errors="replace").rstrip("\r\n")
+                # echo to CI logs, batched (see ECHO_FLUSH_BYTES / ECHO_FLUSH_S)
+                echo += raw.rstrip(b"\r\n")
+                echo += b"\n"
+                if len(echo) >= ECHO_FLUSH_BYTES:
+                    flush_echo()
+                elif flush_handle is None:
+                    flush_handle = loop.call_later(ECHO_FLUSH_S, flush_echo)
+                f.write(line + "\n")
+                if done:
+                    done_event.set()
+                    break
+    finally:
+        flush_echo()
 
 
 async def drive_pushbutton(client: WokwiClient, schedule: List[Tuple[float, float]]):
     """
     Drive a Wokwi pushbutton peripheral (part id 'btn1') using control updates.
     Use small guard bands around the requested time with wait_until_simulation_time.
+    The schedule is flattened into one sorted edge list so each press/release costs
+    a single simulation-time barrier.
     - set_control: toggle the 'pressed' control of the button. :contentReference[oaicite:3]{index=3}
     """
-    for t_press, t_release in schedule:
-        # tiny pre-roll before the press
-        await client.wait_until_simulation_time(max(0.0, t_press - 0.002))
+    # (sim time, pressed value, requested time): tiny pre-roll before a press, post-roll after a release
+    edges = sorted(
+        [(max(0.0, t_press - 0.002), 1, t_press) for t_press, _t_release in schedule]
+        + [(t_release + 0.002, 0, t_release) for _t_press, t_release in schedule]
+    )
+    wait, set_control = client.wait_until_simulation_time, client.set_control  # bound once for the loop
+    for t_edge, value, t_requested in edges:
+        await wait(t_edge)
         try:
-            await client.set_control(part="btn1", control="pressed", value=1)
+            await set_control(part="btn1", control="pressed", value=value)
         except Exception as e:
-            print(f"[autograde] set_control press failed @ {t_press:.3f}s: {e!r}", file=sys.stderr)
-        # tiny post-roll
-        await client.wait_until_simulation_time(t_press + 0.002)
+            action = "press" if value else "release"
+            print(f"[autograde] set_control {action} failed @ {t_requested:.3f}s: {e!r}", file=sys.stderr)
 
-        # hold until release time, then release
-        await client.wait_until_simulation_time(t_release + 0.002)
-        try:
-            await client.set_control(part="btn1", control="pressed", value=0)
-        except Exception as e:
-            print(f"[autograde] set_control release failed @ {t_release:.3f}s: {e!r}", file=sys.stderr)
 
-
-async def sample_probes(client: WokwiClient, probes: List[Tuple[str, str, str]], times: List[float]):
+async def sample_probes(client: WokwiClient, times: List[float]):
     """
-    Sample defined probes at precise simulation timestamps and write artifacts/probes.csv
-    Columns: time_s, <label1>, <label2>, ...
+    Sample PROBES at precise simulation timestamps and write artifacts/probes.csv
+    Columns: PROBE_HEADER (time_s, <label1>, <label2>, ...)
     - read_pin: reads the digital level; for analog, Wokwi docs describe peripherals that expose other controls. :contentReference[oaicite:4]{index=4}
     """
     ensure_artifacts_dir()
-    header = ["time_s"] + [label for *_ignore, label in probes]
     with PROBES_LOG.open("w", encoding="utf-8", newline="") as f:
         writer = csv.writer(f)
-        writer.writerow(header)
+        writer.writerow(PROBE_HEADER)
 
-        for t in times:
-            await client.wait_until_simulation_time(t)
-            row = [f"{t:.6f}"]
-            for part, pin, _label in probes:
-                try:
-                    val = await client.read_pin(part=part, pin=pin)  # 0/1 for digital
-                except Exception as e:
-                    print(f"[autograde] read_pin({part},{pin}) failed at {t:.3f}s: {e!r}", file=sys.stderr)
-                    val = "ERR"
-                row.append(val)
-            writer.writerow(row)
+        wait, read_pin = client.wait_until_simulation_time, client.read_pin  # bound once for the loop
+        rows = []
+        try:
+            for t in times:
+                await wait(t)
+                # All probes at this timestamp are read concurrently (one round-trip window)
+                results = await asyncio.gather(
+                    *(read_pin(part=part, pin=pin) for part, pin, _label in PROBES),
+                    return_exceptions=True,
+                )
+                row = [f"{t:.6f}"]
+                for (part, pin, _label), val in zip(PROBES, results):  # 0/1 for digital
+                    if isinstance(val, Exception):
+                        print(f"[autograde] read_pin({part},{pin}) failed at {t:.3f}s: {val!r}", file=sys.stderr)
+                        val = "ERR"
+                    row.append(val)
+                rows.append(row)
+                if len(rows) >= PROBE_FLUSH_ROWS:
+                    writer.writerows(rows)
+                    rows.clear()
+                    f.flush()  # push each batch to disk so a crash mid-run keeps it
+        finally:
+            writer.writerows(rows)  # keep samples taken so far, even on failure/cancellation
 
 
 async def run_simulation_and_grade():
@@ -190,53 +264,55 @@ async def run_simulation_and_grade():
     if firmware_elf:
         await client.upload_file("firmware.elf", local_path=firmware_elf)
 
-    # Kick off serial capture before starting simulation
+    # Serial capture, input driving and probe sampling share one TaskGroup, so an
+    # error in any of them (or in start_simulation) tears the others down cleanly.
+    # Such errors are reported and grading still runs: partial logs grade as FAIL.
     done_event = asyncio.Event()
-    serial_task = asyncio.create_task(capture_serial(client._transport, done_event))
-
-    # Start simulation
-    await client.start_simulation(firmware="firmware.bin", elf="firmware.elf" if firmware_elf else None)
-
-    # Drive inputs + run probe sampler concurrently
     probe_times = make_probe_schedule()
-    drive_task = asyncio.create_task(drive_pushbutton(client, BUTTON_PRESSES))
-    probe_task = asyncio.create_task(sample_probes(client, PROBES, probe_times))
-
-    # Wait for serial "DONE" or overall timeout (whichever first)
     try:
-        await asyncio.wait_for(done_event.wait(), timeout=TIMEOUT_S)
-    except asyncio.TimeoutError:
-        print("[autograde] Timeout waiting for DONE", file=sys.stderr)
-
-    # (Optional) pause/stop – the API supports pause/resume/stop if you want shorter VCDs in UI runs. :contentReference[oaicite:7]{index=7}
-    # try:
-    #     await client.pause_simulation()
-    # except Exception as e:
-    #     print(f"[autograde] pause_simulation failed: {e!r}", file=sys.stderr)
-
-    # Ensure our tasks complete
-    await asyncio.gather(drive_task, probe_task, return_exceptions=True)
-
-    # Wrap up
-    try:
-        await client.disconnect()
+        async with asyncio.TaskGroup() as tg:
+            # Kick off serial capture before starting simulation
+            serial_task = tg.create_task(capture_serial(client._transport, done_event))
+
+            # Start simulation
+            await client.start_simulation(firmware="firmware.bin", elf="firmware.elf" if firmware_elf else None)
+
+            # Drive inputs + run probe sampler concurrently
+            tg.create_task(drive_pushbutton(client, BUTTON_PRESSES))
+            tg.create_task(sample_probes(client, probe_times))
+
+            # Wait for serial "DONE" or overall timeout (whichever first)
+            try:
+                await asyncio.wait_for(done_event.wait(), timeout=TIMEOUT_S)
+            except asyncio.TimeoutError:
+                print("[autograde] Timeout waiting for DONE", file=sys.stderr)
+
+            # (Optional) pause/stop – the API supports pause/resume/stop if you want shorter VCDs in UI runs. :contentReference[oaicite:7]{index=7}
+            # try:
+            #     await client.pause_simulation()
+            # except Exception as e:
+            #     print(f"[autograde] pause_simulation failed: {e!r}", file=sys.stderr)
+
+            # Serial capture has no natural end after a timeout; leaving the group
+            # then waits for the drive/probe tasks to complete.
+            serial_task.cancel()
+    except* Exception as eg:
+        for e in eg.exceptions:
+            print(f"[autograde] simulation task failed: {e!r}", file=sys.stderr)
     finally:
-        # Make sure serial task cannot hang forever
-        serial_task.cancel()
-        with contextlib.suppress(Exception):
-            await serial_task
+        await client.disconnect()
 
     # -----------------------
     # Grading (serial diff)
     # -----------------------
-    actual_serial = read_expected_lines(SERIAL_LOG)
-    expected_serial = read_expected_lines(EXPECTED_SERIAL_PATH)
-
-    serial_pass = (expected_serial == actual_serial) if expected_serial else True
-    if expected_serial:
-        diff = unified_diff_str(expected_serial, actual_serial, fromfile=str(EXPECTED_SERIAL_PATH), tofile=str(SERIAL_LOG))
-        if diff:
-            print("\n[DIFF] Serial output mismatch:\n" + diff)
+    # Log lines are only decoded/split when a diff has to be shown.
+    serial_pass = True
+    if EXPECTED_SERIAL_PATH.exists() and EXPECTED_SERIAL_PATH.stat().st_size:
+        serial_lines = read_changed_logs(EXPECTED_SERIAL_PATH, SERIAL_LOG)
+        serial_pass = serial_lines is None or serial_lines[0] == serial_lines[1]
+        if not serial_pass:
+            print("\n[DIFF] Serial output mismatch:")
+            stream_unified_diff(*serial_lines, fromfile=str(EXPECTED_SERIAL_PATH), tofile=str(SERIAL_LOG))
         else:
             print("\n[OK] Serial output matches golden copy.")
 
@@ -245,14 +321,13 @@ async def run_simulation_and_grade():
     # -----------------------
     probes_pass = True
     if EXPECTED_PROBES_CSV.exists():
-        expected_csv_lines = read_expected_lines(EXPECTED_PROBES_CSV)
-        actual_csv_lines = read_expected_lines(PROBES_LOG)
-        probes_pass = (expected_csv_lines == actual_csv_lines)
+        probes_lines = read_changed_logs(EXPECTED_PROBES_CSV, PROBES_LOG)
+        probes_pass = probes_lines is None or probes_lines[0] == probes_lines[1]
         if not probes_pass:
-            diff = unified_diff_str(expected_csv_lines, actual_csv_lines,
-                                    fromfile=str(EXPECTED_PROBES_CSV),
-                                    tofile=str(PROBES_LOG))
-            print("\n[DIFF] Probes CSV mismatch:\n" + diff)
+            print("\n[DIFF] Probes CSV mismatch:")
+            stream_unified_diff(*probes_lines,
+                                fromfile=str(EXPECTED_PROBES_CSV),
+                                tofile=str(PROBES_LOG))
         else:
             print("\n[OK] Probes CSV matches golden copy.")
 
@@ -268,9 +343,8 @@ async def run_simulation_and_grade():
 # ---------------
 # Entrypoint
 # ---------------
-import contextlib
 def main():
-    asyncio.run(run_simulation_and_grade())
+    (getattr(uvloop, "run", None) or asyncio.run)(run_simulation_and_grade())
 
 if __name__ == "__main__":
     main()
@@ -14,19 +14,34 @@ Notes:
   - Deterministic by default: fixed RANDOM_SEED plus fixed IMPORTANT_TIMES.
   - No serial I/O is used for grading or completion.
   - If you change sampling times or seed, regenerate the golden CSV.
+  - Run time is dominated by round-trips to the Wokwi server, not CPU. Speed it up
+    by issuing fewer or batched awaits (asyncio.gather, one barrier per sim time);
+    threads or worker processes only add overhead here. The phase summary
+    printed at exit shows where the time went.
 """
 
 import asyncio
 import csv
-import difflib
+import io
 import os
 import pathlib
 import random
 import sys
-from typing import Iterable, List, Tuple
+import time
+from typing import Dict, Iterable, List, Tuple
 
 from wokwi_client import WokwiClient, GET_TOKEN_URL  # https://wokwi.github.io/wokwi-python-client/
 
+try:
+    import uvloop  # optional: libuv-backed event loop; pre-0.18 (no uvloop.run) falls back to asyncio
+except ImportError:
+    uvloop = None
+
+try:
+    from difflib_rs import unified_diff  # optional: native drop-in for difflib.unified_diff
+except ImportError:
+    from difflib import unified_diff
+
 # -----------------------
 # Config
 # -----------------------
@@ -38,28 +53,57 @@ RANDOM_SEED = 1337                  # keep fixed for deterministic random sample
 IMPORTANT_TIMES = [0.48, 0.70, 0.90, 1.10]
 NUM_RANDOM_TIMES = 6                # additional random samples in [t_min, t_max]
 RAND_WINDOW = (0.20, 1.60)
+SIM_TIME_EPS = 1e-6                 # actions closer than this share one wait_until_simulation_time()
 
 # Input drive plan for a pushbutton named "btn1" in diagram.json
 BUTTON_PRESSES = [
     (0.50, 0.70),                   # press at 0.50s, release at 0.70s
     (0.90, 1.10),                   # press at 0.90s, release at 1.10s
 ]
+# Flattened once into sorted (sim_time, pressed, requested_time) edges:
+# 2 ms pre-roll before each press, 2 ms post-roll after each release.
+BUTTON_EDGES: List[Tuple[float, int, float]] = sorted(
+    [(max(0.0, t_press - 0.002), 1, t_press) for t_press, _t_release in BUTTON_PRESSES]
+    + [(t_release + 0.002, 0, t_release) for _t_press, t_release in BUTTON_PRESSES]
+)
 
 # Probes to sample (part, pin, label) -> CSV columns are time_s + labels
-PROBES: List[Tuple[str, str, str]] = [
+PROBES: Tuple[Tuple[str, str, str], ...] = (
     ("esp", "D26", "LED"),
     ("esp", "D4",  "BTN"),
     ("esp", "D5",  "D5"),
-]
+)
+# Derived once at import: (part, pin) pairs to read, and the CSV header row
+PROBE_PINS = tuple((part, pin) for part, pin, _label in PROBES)
+PROBE_HEADER = ["time_s", *(label for _, _, label in PROBES)]
 
 # Artifacts
 ARTIFACT_DIR = pathlib.Path("tools/artifacts")
 PROBES_LOG   = ARTIFACT_DIR / "probes.csv"
 
+# Wall-clock nanoseconds per phase ("upload", "wait", "control", "read_pin", "csv_write", "diff")
+PHASE_NS: Dict[str, int] = {}
+
 # -----------------------
 # Helpers
 # -----------------------
 
+class Phase:
+    """Context manager adding the time spent in its block to PHASE_NS[name]."""
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+
+    def __exit__(self, *exc):
+        PHASE_NS[self.name] = PHASE_NS.get(self.name, 0) + time.perf_counter_ns() - self.t0
+
+def phase_summary() -> str:
+    return "phase=" + " ".join(f"{name} {ns / 1e9:.2f}s" for name, ns in PHASE_NS.items())
+
 def ensure_artifacts_dir():
     ARTIFACT_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -73,69 +117,111 @@ def find_firmware(build_dir: pathlib.Path = pathlib.Path("build")) -> pathlib.Pa
 
 def make_probe_schedule() -> List[float]:
     """Merge fixed 'important' times with seeded-random times and sort."""
-    random.seed(RANDOM_SEED)
+    rng = random.Random(RANDOM_SEED)  # private generator: leaves the global random state alone
     t_min, t_max = RAND_WINDOW
-    rand_times = [random.uniform(t_min, t_max) for _ in range(NUM_RANDOM_TIMES)]
-    return sorted(set(IMPORTANT_TIMES + rand_times))
+    span = t_max - t_min
+    # Random draws go straight into the de-dup set (no intermediate lists to concatenate)
+    return sorted({*IMPORTANT_TIMES, *(rng.random() * span + t_min for _ in range(NUM_RANDOM_TIMES))})
+
+def make_timeline(edges: List[Tuple[float, int, float]],
+                  times: List[float]) -> List[Tuple[float, List[Tuple[int, float]], List[float]]]:
+    """
+    Merge button edges (see BUTTON_EDGES) and probe times into
+    (sim_time, [(pressed, requested_time), ...], [sample_time, ...]) entries, sorted by sim time.
+    Actions within SIM_TIME_EPS of an entry's time (e.g. 0.7 + 0.002 vs 0.702) are coalesced
+    into it: they share its wait barrier, but every sample time keeps its own CSV row.
+    """
+    events = sorted(
+        [(t, 0, value, t_requested) for t, value, t_requested in edges]
+        + [(t, 1, 0, t) for t in times]  # kind 1 sorts samples after edges at the same time
+    )
+    timeline = []
+    for t, kind, value, t_requested in events:
+        if not timeline or t - timeline[-1][0] >= SIM_TIME_EPS:
+            timeline.append((t, [], []))
+        _t_entry, entry_edges, sample_times = timeline[-1]
+        if kind == 0:
+            entry_edges.append((value, t_requested))
+        else:
+            sample_times.append(t)
+    return timeline
 
 def read_lines(path: pathlib.Path) -> List[str]:
     if not path.exists():
         return []
-    return path.read_text().splitlines()
+    return path.read_text().splitlines()  # ends stripped: a missing final newline still compares equal
+
+def files_identical(a: pathlib.Path, b: pathlib.Path) -> bool:
+    """
+    Byte-for-byte equality of two files; False if either is missing.
+    Differing sizes answer immediately; otherwise both are streamed line by
+    line (raw bytes, never decoded) and the scan stops at the first difference.
+    """
+    if not (a.exists() and b.exists()) or a.stat().st_size != b.stat().st_size:
+        return False
+    with a.open("rb") as fa, b.open("rb") as fb:
+        while True:
+            la, lb = fa.readline(), fb.readline()
+            if la != lb:
+                return False
+            if not la:
+                return True
 
 def diff_str(expected: Iterable[str], actual: Iterable[str],
              fromfile="tests/expected_probes.csv", tofile="artifacts/probes.csv") -> str:
-    return "".join(difflib.unified_diff(list(expected), list(actual),
-                                        fromfile=fromfile, tofile=tofile, lineterm=""))
+    return "\n".join(unified_diff(list(expected), list(actual),
+                                  fromfile=fromfile, tofile=tofile, lineterm=""))
 
 # -----------------------
 # Orchestration
 # -----------------------
 
-async def drive_pushbutton(client: WokwiClient, schedule: List[Tuple[float, float]]):
-    """
-    Toggle 'btn1' pressed control at the requested times.
-    Uses wait_until_simulation_time() to align actions with sim time.
+# perf: io-bound (server round-trips) -- batch awaits, don't parallelize on CPU
+async def drive_and_sample(client: WokwiClient,
+                           edges: List[Tuple[float, int, float]],
+                           times: List[float],
+                           rows: List[list],
+                           errors: List[str]) -> None:
     """
-    for t_press, t_release in schedule:
-        await client.wait_until_simulation_time(max(0.0, t_press - 0.002))
-        try:
-            await client.set_control(part="btn1", control="pressed", value=1)
-        except Exception as e:
-            print(f"[autograde] set_control press failed @{t_press:.3f}s: {e!r}", file=sys.stderr)
-
-        await client.wait_until_simulation_time(t_press + 0.002)
-        await client.wait_until_simulation_time(t_release + 0.002)
-
-        try:
-            await client.set_control(part="btn1", control="pressed", value=0)
-        except Exception as e:
-            print(f"[autograde] set_control release failed @{t_release:.3f}s: {e!r}", file=sys.stderr)
-
-async def sample_probes(client: WokwiClient,
-                        probes: List[Tuple[str, str, str]],
-                        times: List[float]):
+    Toggle 'btn1' and sample PROBES from one merged timeline, appending CSV rows
+    (time_s, <label1>, <label2>, ...) to the caller-owned `rows`.
+    Each distinct sim time costs a single wait_until_simulation_time(); at a
+    shared timestamp the button edge is applied before the probes are read.
+    No file I/O happens here, so nothing blocks the event loop between sim-time barriers;
+    failures are appended to `errors` for the caller to report afterwards, and rows
+    sampled before a failure or cancellation stay with the caller.
     """
-    Sample probes at specific timestamps and write a CSV:
-      time_s, <label1>, <label2>, ...
-    """
-    ensure_artifacts_dir()
-    header = ["time_s"] + [label for _, _, label in probes]
-    with PROBES_LOG.open("w", encoding="utf-8", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(header)
-
-        for t in times:
-            await client.wait_until_simulation_time(t)
-            row = [f"{t:.6f}"]
-            for part, pin, _label in probes:
-                try:
-                    val = await client.read_pin(part=part, pin=pin)  # digital: 0/1
-                except Exception as e:
-                    print(f"[autograde] read_pin({part},{pin}) failed @{t:.3f}s: {e!r}", file=sys.stderr)
-                    val = "ERR"
-                row.append(val)
-            writer.writerow(row)
+    # Client methods bound once for the loop
+    wait, set_control, read_pin = client.wait_until_simulation_time, client.set_control, client.read_pin
+
+    for t, t_edges, sample_times in make_timeline(edges, times):
+        with Phase("wait"):
+            await wait(t)
+
+        for value, t_requested in t_edges:
+            try:
+                with Phase("control"):
+                    await set_control(part="btn1", control="pressed", value=value)
+            except Exception as e:
+                action = "press" if value else "release"
+                errors.append(f"[autograde] set_control {action} failed @{t_requested:.3f}s: {e!r}")
+
+        if not sample_times:
+            continue
+        # One round-trip window for all probes at this timestamp
+        with Phase("read_pin"):
+            results = await asyncio.gather(
+                *(read_pin(part=part, pin=pin) for part, pin in PROBE_PINS),
+                return_exceptions=True,
+            )
+        vals = []
+        for (part, pin), val in zip(PROBE_PINS, results):  # digital: 0/1
+            if isinstance(val, Exception):
+                errors.append(f"[autograde] read_pin({part},{pin}) failed @{sample_times[0]:.3f}s: {val!r}")
+                val = "ERR"
+            vals.append(val)
+        # Coalesced sample times share this read but each keeps its own row
+        rows.extend([f"{sample_time:.6f}", *vals] for sample_time in sample_times)
 
 async def run_and_grade():
     token = os.getenv("WOKWI_CLI_TOKEN")
@@ -151,19 +237,35 @@ async def run_and_grade():
     await client.connect()
 
     # Upload files; filenames should match your diagram.json / wokwi.toml expectations.
-    await client.upload_file("diagram.json")
-    await client.upload_file("firmware.bin", local_path=firmware_bin)
+    # The uploads are independent, so they run concurrently.
+    uploads = [
+        client.upload_file("diagram.json"),
+        client.upload_file("firmware.bin", local_path=firmware_bin),
+    ]
     if firmware_elf:
-        await client.upload_file("firmware.elf", local_path=firmware_elf)
+        uploads.append(client.upload_file("firmware.elf", local_path=firmware_elf))
+    with Phase("upload"):
+        await asyncio.gather(*uploads)
 
     await client.start_simulation(firmware="firmware.bin", elf="firmware.elf" if firmware_elf else None)
 
-    # Run input driving + probe sampling concurrently.
+    # Drive inputs + sample probes along one timeline (a single sim-time barrier per timestamp).
     times = make_probe_schedule()
-    await asyncio.gather(
-        drive_pushbutton(client, BUTTON_PRESSES),
-        sample_probes(client, PROBES, times),
-    )
+    probe_rows: List[list] = [PROBE_HEADER]
+    errors: List[str] = []
+    try:
+        await drive_and_sample(client, BUTTON_EDGES, times, probe_rows, errors)
+    finally:
+        if errors:  # reported in one write, outside the time-sensitive loop
+            sys.stderr.write("\n".join(errors) + "\n")
+        # Whole CSV in one write once the timeline ends, so a failed run never leaves a
+        # stale probes.csv behind. csv.writer keeps quoting (read_pin values may contain
+        # commas) and its usual "\r\n" rows.
+        ensure_artifacts_dir()
+        with Phase("csv_write"):
+            buf = io.StringIO(newline="")
+            csv.writer(buf).writerows(probe_rows)
+            PROBES_LOG.write_text(buf.getvalue(), encoding="utf-8", newline="")
 
     # Optional: pause/stop if desired; not required for grading.
     # await client.pause_simulation()
@@ -171,25 +273,36 @@ async def run_and_grade():
     await client.disconnect()
 
     # Grade based ONLY on probes.csv
-    actual = read_lines(PROBES_LOG)
-    expected = read_lines(EXPECTED_PROBES_CSV)
-    if not expected:
+    if not EXPECTED_PROBES_CSV.exists() or not EXPECTED_PROBES_CSV.stat().st_size:
         print("No golden probes CSV found. To create one, copy artifacts/probes.csv -> tests/expected_probes.csv")
         print("\n=== GRADE: PASS (no golden to compare) ===")
         raise SystemExit(0)
 
+    # Fast path: identical bytes need no decoding. Otherwise compare lines, so
+    # line-ending-only differences still pass, and keep them for the diff.
+    expected = actual = None
+    with Phase("diff"):
+        if not files_identical(EXPECTED_PROBES_CSV, PROBES_LOG):
+            expected, actual = read_lines(EXPECTED_PROBES_CSV), read_lines(PROBES_LOG)
+
     if expected == actual:
         print("\n[OK] Probes CSV matches golden copy.")
         print("\n=== GRADE: PASS ===")
         raise SystemExit(0)
 
     print("\n[DIFF] Probes CSV mismatch:")
-    print(diff_str(expected, actual))
+    with Phase("diff"):
+        diff = diff_str(expected, actual)
+    print(diff)
     print("\n=== GRADE: FAIL ===")
     raise SystemExit(1)
 
 def main():
-    asyncio.run(run_and_grade())
+    try:
+        (getattr(uvloop, "run", None) or asyncio.run)(run_and_grade())
+    finally:
+        if PHASE_NS:
+            print(f"[autograde] {phase_summary()}", file=sys.stderr)
 
 if __name__ == "__main__":
     main()